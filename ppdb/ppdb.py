@@ -1,36 +1,78 @@
 # -*- coding: utf-8 -*-
 
-from __future__ import division, print_function, unicode_literals
-
 """
 Classes and functions for dealing with data from the paraphrase database (PPDB)
 """
 
-from six import string_types
-from six.moves import cPickle
+import gc
+import multiprocessing
+import os
+import pickle
+from array import array
+from sys import intern
 
 
 _ppdb_dict = None
 
+# token ids are stored as (at least) 32 bit unsigned integers
+_ID_TYPECODE = 'I' if array('I').itemsize >= 4 else 'L'
+_ID_SIZE = array(_ID_TYPECODE).itemsize
+
+
+class _LeafChildren(dict):
+    """
+    Empty, read-only dict shared as the children of leaf nodes.
+
+    TransformationDict.add replaces it with a new dict before adding a child.
+    """
+    __slots__ = ()
+
+    def _read_only(self, *args, **kwargs):
+        raise TypeError('the children of leaf nodes are read-only; use '
+                        'TransformationDict.add to insert rules')
+
+    __setitem__ = __delitem__ = __ior__ = _read_only
+    clear = pop = popitem = setdefault = update = _read_only
+
+
+_LEAF_CHILDREN = _LeafChildren()
 
-class TransformationDict(dict):
+# returned by lookups of LHS without rules, so that they don't allocate anything
+_EMPTY_SET = frozenset()
+_EMPTY_RESULT = (_EMPTY_SET, None)
+
+
+class TransformationDict:
     """
-    Class storing a dictionary for phrasal, lexical and/or syntactic
+    Class storing a trie for phrasal, lexical and/or syntactic
     transformations.
+
+    Trie nodes are identified by integers and stored in parallel lists:
+    `children[node]` maps a token to the id of the child node, and
+    `rules[node]` is the set of RHS of the LHS ending at that node (or None if
+    there is no such rule). Node 0 is the root.
     """
+    __slots__ = ('children', 'rules', 'index', 'token_ids', 'id_tokens')
+
     def __init__(self):
         """
         Well, init the object.
         """
-        # each key in self is a token, and each value is a tuple (set, dict).
-        super(TransformationDict, self).__init__()
-
-        # this indexes words in the middle of a RHS rule
-        # ex: self.index[word1] == {(word2, word3): RHS-continuing-in-word1}
-        # where RHS-continuing-in-word1 is a nested entry in self
-        # ignore the above. now each key maps into (before, after) in the LHS
-        # rules the key is part of
+        self.children = [{}]
+        self.rules = [None]
+
+        # each key maps into (before, after) in the LHS rules the key is part of
+        # before and after are stored encoded with the token ids below
         self.index = {}
+        self.token_ids = {}
+        self.id_tokens = []
+
+    def __getstate__(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
 
     def add(self, lhs, rhs):
         """
@@ -39,32 +81,39 @@ class TransformationDict(dict):
         :param lhs: left-hand side, tuple of strings
         :param rhs: left-hand side, tuple of strings
         """
-        d = self
         if len(lhs) == 0:
             return
 
-        # this keeps track of the LHS before each new token
-        # partial_lhs = []
+        if len(lhs) > 2:
+            # the contexts of the middle tokens are sliced from a single
+            # encoding of the whole LHS
+            encoded_lhs = _encode_tokens(lhs, self.token_ids, self.id_tokens)
 
+        children = self.children
+        rules = self.rules
+        node = 0
         for i, token in enumerate(lhs):
-            if token in d:
-                rule_set, d = d[token]
-            else:
-                rule_set = set()
-                new_d = TransformationDict()
-                d[token] = (rule_set, new_d)
-                d = new_d
-
-            # if len(partial_lhs):
-            #     self.index[token][tuple(partial_lhs)] = d
+            node_children = children[node]
+            next_node = node_children.get(token)
+            if next_node is None:
+                if type(node_children) is _LeafChildren:
+                    node_children = children[node] = {}
+                next_node = len(children)
+                children.append(_LEAF_CHILDREN)
+                rules.append(None)
+                node_children[token] = next_node
+            node = next_node
+
             if 0 < i < len(lhs) - 1:
                 if token not in self.index:
                     self.index[token] = set()
-                before = tuple(lhs[:i])
-                after = tuple(lhs[i+1:])
+                before = encoded_lhs[:i * _ID_SIZE]
+                after = encoded_lhs[(i + 1) * _ID_SIZE:]
                 self.index[token].add((before, after))
-            # partial_lhs.append(token)
 
+        rule_set = rules[node]
+        if rule_set is None:
+            rule_set = rules[node] = set()
         rule_set.add(rhs)
 
     def find_partial_expression(self, partial):
@@ -82,32 +131,41 @@ class TransformationDict(dict):
         if first_token not in self.index:
             return []
 
-        def find_all_paths(d):
+        def find_all_paths(node):
+            # iterative depth-first search, yielding the paths in the same
+            # order as a recursive one
             paths = []
-            for key in d:
-                paths_under_key = [[key] + path
-                                   for path in find_all_paths(d[key][1])]
-
-                if len(paths_under_key) == 0:
-                    paths_under_key = [[key]]
-                paths.extend(paths_under_key)
+            stack = [(node, [])]
+            while stack:
+                node, path = stack.pop()
+                node_children = self.children[node]
+                if len(node_children) == 0:
+                    if len(path) > 0:
+                        paths.append(path)
+                    continue
+
+                for key, child in reversed(list(node_children.items())):
+                    stack.append((child, path + [key]))
 
             return paths
 
-        sought_lhs_tail = tuple(partial[1:])
+        partial = tuple(partial)
+        if any(token not in self.token_ids for token in partial[1:]):
+            return []
+
+        sought_lhs_tail = _encode_tokens(partial[1:], self.token_ids)
         contexts = []
         lhs_heads = [head for head, tail in self.index[first_token]
-                     if tail[:len(sought_lhs_tail) + 1] == sought_lhs_tail]
+                     if tail == sought_lhs_tail]
         for lhs_head in lhs_heads:
-            # d contains transformations with "lhs_head" + "first_token"
-            # we know lhs_tail is also contained here
-            d = self[lhs_head][1][first_token][1]
+            lhs_head = _decode_tokens(lhs_head, self.id_tokens)
 
-            for token in sought_lhs_tail:
-                d = d[token][1]
+            # node contains transformations with "lhs_head" + "partial"
+            node = self[lhs_head + partial][1]
 
-            # explore all paths in d to complete the LHS in a depth-first search
-            contexts_after = find_all_paths(d)
+            # explore all paths in node to complete the LHS in a depth-first
+            # search
+            contexts_after = find_all_paths(node)
             contexts.extend([(lhs_head, context_after)
                              for context_after in contexts_after])
 
@@ -118,34 +176,61 @@ class TransformationDict(dict):
         Return the right-hand side of the rules with the given left-hand side.
 
         :param lhs: tuple/list of strings
-        :return: a set with all the fillers of the right-hand side of the rule
+        :return: a set with all the fillers of the right-hand side of the rule.
+            If there is no rule, an empty frozenset is returned.
         """
+        if isinstance(lhs, str):
+            # single tokens are the most common lookup; go straight to the root
+            node = self.children[0].get(lhs)
+            if node is None:
+                return _EMPTY_SET
+            return self.rules[node] or _EMPTY_SET
+
         return self[lhs][0]
 
     def __getitem__(self, lhs):
-        if isinstance(lhs, string_types):
-            if lhs in self:
-                return super(TransformationDict, self).__getitem__(lhs)
-            return set(), TransformationDict()
+        children = self.children
+        if isinstance(lhs, str):
+            node = children[0].get(lhs)
+        else:
+            node = 0
+            for token in lhs:
+                node = children[node].get(token)
+                if node is None:
+                    break
 
-        d = self
-        for token in lhs:
-            if token not in d:
-                return set(), TransformationDict()
+        if node is None:
+            return _EMPTY_RESULT
 
-            rule_set, d = d[token]
+        return self.rules[node] or _EMPTY_SET, node
+
+    def save(self, path):
+        """
+        Save the object to a pickle file, which can be read by `load_ppdb`.
 
-        return rule_set, d
+        :param path: path to the file; it should end in .pickle
+        """
+        with open(path, 'wb') as f:
+            pickle.dump(self, f, pickle.HIGHEST_PROTOCOL)
 
     def get_subdict(self, lhs):
         """
-        Return the TransformationDict associated with the given lhs
+        Return the id of the trie node associated with the given lhs, or None
+        if there is no such node.
         """
         return self[lhs][1]
 
 
-def load_ppdb(path, is_trivial=lambda e1, e2: False,
-              clean_expression=lambda x: x, force=False):
+def _never_trivial(lhs, rhs):
+    return False
+
+
+def _keep_expression(expression):
+    return expression
+
+
+def load_ppdb(path, is_trivial=_never_trivial,
+              clean_expression=_keep_expression, force=False, processes=1):
     """
     Load a paraphrase file from Paraphrase Database.
 
@@ -161,127 +246,262 @@ def load_ppdb(path, is_trivial=lambda e1, e2: False,
         RHS or LHS of a rule) and cleans it, usually removing articles.
     :param force: if False and the dictionary is already loaded, do nothing.
         If True, always load the dictionary.
-    :return: a nested dictionary containing transformations.
-        each level of the dictionary has one token of the right-hand side of
-        the transformation rule mapping to a tuple (transformations, dict):
-        ex:
-        {'poder': (set(),
-                   {'legislativo': (set('legislatura',
-                                    {})})
-        }
+    :param processes: number of processes parsing the file. If None, use the
+        number of CPUs; values up to 1 parse it in the current process. With
+        more than one process, is_trivial and clean_expression must be
+        picklable (e.g., module-level functions).
+    :return: a TransformationDict containing the transformations
     """
     global _ppdb_dict
     if _ppdb_dict is not None and not force:
         return _ppdb_dict
 
     if path.endswith('.pickle'):
-        with open(path, 'rb') as f:
-            _ppdb_dict = cPickle.load(f)
+        # none of the millions of objects being unpickled is garbage, so don't
+        # let the collector traverse them over and over
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            with open(path, 'rb') as f:
+                transformations = pickle.load(f)
+        except TypeError:
+            # pickles from when TransformationDict was a dict subclass can't be
+            # loaded into the current class
+            transformations = None
+        finally:
+            if gc_enabled:
+                gc.enable()
+
+        if not isinstance(transformations, TransformationDict):
+            raise ValueError('%s does not contain a TransformationDict in the '
+                             'current format; re-create the pickle from the '
+                             'PPDB file' % path)
+
+        _ppdb_dict = transformations
         return _ppdb_dict
 
     transformations = TransformationDict()
 
+    add = transformations.add
+    if processes is not None and processes <= 1:
+        with open(path, 'rb') as f:
+            for lhs, rhs in _parse_lines(f, is_trivial, clean_expression):
+                # add rhs to the transformation dictionary
+                add(lhs, rhs)
+    else:
+        # leaving the block terminates the pool, without waiting for the
+        # remaining chunks if a worker fails
+        with multiprocessing.Pool(processes) as pool:
+            # a few chunks per process balance the load between them
+            num_chunks = 4 * (processes or multiprocessing.cpu_count())
+            boundaries = _find_chunk_boundaries(path, num_chunks)
+            chunks = [(path, start, end, is_trivial, clean_expression)
+                      for start, end in zip(boundaries, boundaries[1:])]
+
+            # rules coming from different workers don't share objects anymore
+            rhs_pool = {}
+            for rules in pool.imap(_parse_chunk, chunks):
+                for lhs, rhs in rules:
+                    pooled_rhs = rhs_pool.get(rhs)
+                    if pooled_rhs is None:
+                        pooled_rhs = rhs_pool[rhs] = tuple(
+                            [intern(token) for token in rhs])
+                    add(tuple([intern(token) for token in lhs]), pooled_rhs)
+
+    _ppdb_dict = transformations
+
+    return transformations
+
+
+def _find_chunk_boundaries(path, num_chunks):
+    """
+    Split a file into chunks of roughly the same size ending in line breaks.
+
+    :param path: path to the file
+    :param num_chunks: maximum number of chunks
+    :return: list of offsets, starting at 0 and ending at the file size
+    """
+    size = os.path.getsize(path)
+    boundaries = [0]
     with open(path, 'rb') as f:
-        for line in f:
-            line = line.decode('utf-8')
-            # discard lines with unrecoverable encoding errors
-            if '\\ x' in line or 'xc3' in line:
+        for i in range(1, num_chunks):
+            position = size * i // num_chunks
+            if position <= boundaries[-1]:
                 continue
-            fields = line.split('|||')
-            lhs = fields[1].strip().split()
-            rhs = fields[2].strip().split()
 
-            lhs = tuple(clean_expression(lhs))
-            rhs = tuple(clean_expression(rhs))
+            # move to the beginning of the next line
+            f.seek(position - 1)
+            f.readline()
+            position = f.tell()
+            if position >= size:
+                break
+            boundaries.append(position)
 
-            if len(lhs) == 0 or len(rhs) == 0:
-                continue
+    boundaries.append(size)
+    return boundaries
 
-            # filter out trivial number/gender variations
-            if is_trivial(lhs, rhs):
-                continue
 
-            # add rhs to the transformation dictionary
-            transformations.add(lhs, rhs)
+def _parse_chunk(args):
+    """
+    Parse the lines of a chunk of a PPDB file, in a worker process.
 
-    _ppdb_dict = transformations
+    :param args: tuple (path, start, end, is_trivial, clean_expression)
+    :return: list of (lhs, rhs) tuples
+    """
+    path, start, end, is_trivial, clean_expression = args
+    with open(path, 'rb') as f:
+        f.seek(start)
+        lines = f.read(end - start).split(b'\n')
 
-    return transformations
+    # the chunk ends in a line break
+    if len(lines[-1]) == 0:
+        lines.pop()
 
+    return list(_parse_lines(lines, is_trivial, clean_expression))
 
-def search(haystack, needle):
+
+def _parse_lines(lines, is_trivial, clean_expression):
     """
-    Search list `haystack` for sublist `needle` using Boyer-Moore algorithm.
+    Parse raw PPDB lines, yielding the (lhs, rhs) rules that pass the filters.
+
+    :param lines: iterable of bytes, such as a file opened in binary mode
+    :param is_trivial: see `load_ppdb`
+    :param clean_expression: see `load_ppdb`
+    :return: generator of (lhs, rhs) tuples of strings
     """
-    if len(needle) == 0:
-        return 0
-    char_table = make_char_table(needle)
-    offset_table = make_offset_table(needle)
-    i = len(needle) - 1
-    while i < len(haystack):
-        j = len(needle) - 1
-        while needle[j] == haystack[i]:
-            if j == 0:
-                return i
-            i -= 1
-            j -= 1
-        i += max(offset_table[len(needle) - 1 - j],
-                 char_table.get(haystack[i], -1))
-    return -1
-
-
-def make_char_table(needle):
+    # tokens are interned and equal RHS tuples share a single object, since
+    # the same ones are repeated across millions of rules
+    rhs_pool = {}
+    for line in lines:
+        # discard lines with unrecoverable encoding errors
+        if b'\\ x' in line or b'xc3' in line:
+            continue
+        line = line.decode('utf-8')
+        fields = line.split('|||', 3)
+        lhs = tuple(clean_expression(
+            [intern(token) for token in fields[1].split()]))
+        if len(lhs) == 0:
+            continue
+
+        rhs = tuple(clean_expression(
+            [intern(token) for token in fields[2].split()]))
+        if len(rhs) == 0:
+            continue
+
+        # filter out trivial number/gender variations
+        if is_trivial(lhs, rhs):
+            continue
+
+        yield lhs, rhs_pool.setdefault(rhs, rhs)
+
+
+def _encode_tokens(tokens, token_ids, id_tokens=None):
     """
-    Makes the jump table based on the mismatched character information.
+    Encode a sequence of tokens as a bytes string of fixed-width token ids.
+
+    :param tokens: sequence of strings
+    :param token_ids: dictionary mapping tokens to ids; new tokens are added
+    :param id_tokens: if given, list mapping ids back to tokens; new tokens are
+        appended to it
+    :return: bytes
     """
-    table = {}
-    for i in range(len(needle) - 1):
-        table[needle[i]] = len(needle) - 1 - i
-    return table
+    get_id = token_ids.get
+    ids = array(_ID_TYPECODE)
+    append = ids.append
+    for token in tokens:
+        token_id = get_id(token)
+        if token_id is None:
+            token_id = token_ids[token] = len(token_ids)
+            if id_tokens is not None:
+                id_tokens.append(token)
+        append(token_id)
+
+    return ids.tobytes()
 
 
-def make_offset_table(needle):
+def _decode_tokens(data, id_tokens):
     """
-    Makes the jump table based on the scan offset in which mismatch occurs.
+    Decode a bytes string created by `_encode_tokens`.
+
+    :param data: bytes
+    :param id_tokens: list mapping ids to tokens
+    :return: tuple of strings
     """
-    table = []
-    last_prefix_position = len(needle)
-    for i in reversed(range(len(needle))):
-        if is_prefix(needle, i + 1):
-            last_prefix_position = i + 1
-        table.append(last_prefix_position - i + len(needle) - 1)
-    for i in range(len(needle) - 1):
-        slen = suffix_length(needle, i)
-        table[slen] = len(needle) - 1 - i + slen
-    return table
-
-
-def is_prefix(needle, p):
+    ids = array(_ID_TYPECODE)
+    ids.frombytes(data)
+    return tuple(id_tokens[token_id] for token_id in ids)
+
+
+class EncodedHaystack:
     """
-    Is needle[p:end] a prefix of needle?
+    A list of tokens encoded for `search`, with its own table of token ids.
     """
-    j = 0
-    for i in range(p, len(needle)):
-        if needle[i] != needle[j]:
-            return 0
-        j += 1
-    return 1
+    __slots__ = ('data', 'token_ids')
+
+    def __init__(self, haystack):
+        self.token_ids = {}
+        self.data = _encode_tokens(haystack, self.token_ids)
 
 
-def suffix_length(needle, p):
+def encode_haystack(haystack):
     """
-    Returns the maximum length of the substring ending at p that is a suffix.
+    Encode a list of tokens to be searched with `search`.
+
+    Searching the same haystack for many needles with the encoded haystack
+    avoids encoding it again in each call.
+
+    :param haystack: list of strings
+    :return: an EncodedHaystack
     """
-    length = 0
-    j = len(needle) - 1
-    for i in reversed(range(p + 1)):
-        if needle[i] == needle[j]:
-            length += 1
-        else:
-            break
-        j -= 1
+    return EncodedHaystack(haystack)
+
+
+def search(haystack, needle):
+    """
+    Search list `haystack` for sublist `needle`.
+
+    Both lists are encoded as token ids, so the actual search is done by
+    `bytes.find`. Ids are assigned to the needle tokens in each call.
+
+    :param haystack: list of strings, or the result of `encode_haystack`
+    :param needle: list of strings
+    :return: the index of the first occurrence of `needle`, or -1
+    """
+    if len(needle) == 0:
+        return 0
 
-    return length
+    if isinstance(haystack, EncodedHaystack):
+        token_ids = haystack.token_ids
+        try:
+            needle_array = array(_ID_TYPECODE,
+                                 [token_ids[token] for token in needle])
+        except KeyError:
+            # a token missing from the haystack
+            return -1
+
+        encoded_needle = needle_array.tobytes()
+        encoded_haystack = haystack.data
+    else:
+        # only the needle tokens get ids, so nothing outlives the call; all
+        # other tokens in the haystack share the id 0
+        needle_ids = {}
+        for token in needle:
+            if token not in needle_ids:
+                needle_ids[token] = len(needle_ids) + 1
+
+        get_id = needle_ids.get
+        needle_array = array(_ID_TYPECODE, [get_id(token) for token in needle])
+        haystack_array = array(_ID_TYPECODE,
+                               [get_id(token, 0) for token in haystack])
+        encoded_needle = needle_array.tobytes()
+        encoded_haystack = haystack_array.tobytes()
+    position = encoded_haystack.find(encoded_needle)
+
+    # skip matches not aligned with token boundaries
+    while position > 0 and position % _ID_SIZE:
+        position = encoded_haystack.find(encoded_needle, position + 1)
+
+    return position // _ID_SIZE
 
 
 def get_rhs(lhs):
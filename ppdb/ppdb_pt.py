@@ -1,7 +1,5 @@
 # -*- coding: utf-8 -*-
 
-from __future__ import unicode_literals, division, print_function
-
 """
 Functions for filtering trivial paraphrases from PPDB in Portuguese.
 """
@@ -10,6 +8,27 @@ from .ppdb import TransformationDict, get_rhs
 from .ppdb import load_ppdb as _load_ppdb
 
 
+_PREPOSITIONS = frozenset(('de', 'da', 'do', 'das', 'dos',
+                           'em', 'no', 'na', 'nos', 'nas'))
+_ARTICLES = frozenset(('o', 'a', 'os', 'as', 'um', 'uma', 'uns', 'umas'))
+
+_PLURAL_SUFFIXES = ('os', 'as')
+_SINGLE_SUFFIXES = ('a', 'o', 's')
+
+
+def _strip_suffix(word):
+    """
+    Strip gender and number suffixes from a word.
+    """
+    if word.endswith(_PLURAL_SUFFIXES):
+        return word[:-2]
+
+    if word.endswith(_SINGLE_SUFFIXES):
+        return word[:-1]
+
+    return word
+
+
 def _is_trivial_paraphrase(exp1, exp2):
     """
     Return True if:
@@ -20,39 +39,30 @@ def _is_trivial_paraphrase(exp1, exp2):
     :param exp2: tuple/list of strings, expression2
     :return: boolean
     """
-    def strip_suffix(word):
-        if word[-2:] == 'os' or word[-2:] == 'as':
-            return word[:-2]
-
-        if word[-1] in 'aos':
-            return word[:-1]
-
-        return word
-
-    prepositions = {'de', 'da', 'do', 'das', 'dos',
-                    'em', 'no', 'na', 'nos', 'nas'}
-    if exp1[0] in prepositions:
-        exp1 = exp1[1:]
-    if exp2[0] in prepositions:
-        exp2 = exp2[1:]
+    # the expressions are delimited by indices instead of being sliced
+    start1 = 1 if exp1[0] in _PREPOSITIONS else 0
+    start2 = 1 if exp2[0] in _PREPOSITIONS else 0
+    end1 = len(exp1)
+    end2 = len(exp2)
 
-    if len(exp1) == 0 or len(exp2) == 0:
+    if start1 == end1 or start2 == end2:
         return True
 
-    if exp1[-1] in prepositions:
-        exp1 = exp1[:-1]
-    if exp2[-1] in prepositions:
-        exp2 = exp2[:-1]
+    if exp1[end1 - 1] in _PREPOSITIONS:
+        end1 -= 1
+    if exp2[end2 - 1] in _PREPOSITIONS:
+        end2 -= 1
 
-    if len(exp1) != len(exp2):
+    length = end1 - start1
+    if length != end2 - start2:
         return False
 
-    if exp1 == (',',) or exp2 == (',',):
+    if length == 1 and (exp1[start1] == ',' or exp2[start2] == ','):
         return True
 
-    for w1, w2 in zip(exp1, exp2):
-        w1 = strip_suffix(w1)
-        w2 = strip_suffix(w2)
+    for i in range(length):
+        w1 = _strip_suffix(exp1[start1 + i])
+        w2 = _strip_suffix(exp2[start2 + i])
         if len(w1) == 0 or len(w2) == 0:
             if len(w1) == len(w2):
                 continue
@@ -66,9 +76,6 @@ def _is_trivial_paraphrase(exp1, exp2):
     return True
 
 
-articles = {'o', 'a', 'os', 'as', 'um', 'uma', 'uns', 'umas'}
-
-
 def remove_comma_and_article(expression):
     """
     Filter an expression by removing any leading articles and/or commas.
@@ -76,34 +83,35 @@ def remove_comma_and_article(expression):
     :param expression: a list/tuple of strings
     :return: a list of strings
     """
-    if len(expression) == 1:
+    length = len(expression)
+    if length == 1:
         return expression
 
-    while expression[0] in articles or expression[0] == ',':
-        expression = expression[1:]
-        if len(expression) == 0:
-            return expression
+    # find the boundaries first, so that the expression is sliced only once
+    start = 0
+    while start < length and (expression[start] in _ARTICLES or
+                              expression[start] == ','):
+        start += 1
 
-    if expression[-1] == ',':
-        expression = expression[:-1]
-    return expression
+    end = length
+    if start < end and expression[end - 1] == ',':
+        end -= 1
+
+    if start == 0 and end == length:
+        return expression
+    return expression[start:end]
 
 
-def load_ppdb(path, force=False):
+def load_ppdb(path, force=False, processes=1):
     """
     Load the PPDB, filtering data specifically for Portuguese.
 
     :param path: path to the file
     :param force: if False and the dictionary is already loaded, do nothing.
         If True, always load the dictionary.
-    :return: a nested dictionary containing transformations.
-        each level of the dictionary has one token of the right-hand side of
-        the transformation rule mapping to a tuple (transformations, dict):
-        ex:
-        {'poder': (set(),
-                   {'legislativo': (set('legislatura',
-                                    {})})
-        }
+    :param processes: number of processes parsing the file. If None, use the
+        number of CPUs.
+    :return: a TransformationDict containing the transformations
     """
     return _load_ppdb(path, _is_trivial_paraphrase,
-                      remove_comma_and_article, force)
+                      remove_comma_and_article, force, processes)
@@ -18,5 +18,6 @@ setup(
     author_email='erickrfonseca@gmail.com',
     url='https://github.com/erickrf/ppdb',
     license=license_,
-    packages=find_packages()
+    packages=find_packages(),
+    python_requires='>=3'
 )